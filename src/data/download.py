@@ -5,27 +5,43 @@ Usage:
     python src/data/download.py              # download all sources
     python src/data/download.py --only fg    # FlavorGraph only
     python src/data/download.py --only fdb   # FlavorDB only
+    python src/data/download.py --emit-csv   # also write FlavorDB tables as CSV
     TODO: python src/data/download.py --only r1m   # Recipe1M+ only
     TODO: python src/data/download.py --only mstm  # MoleculeSTM weights only
 """
 
-import csv
-import ssl
+import os
+import re
 import time
+import gzip
 import json
 import shutil
+import hashlib
+import asyncio
+import multiprocessing
 import argparse
 import subprocess
-import urllib.error
-import urllib.request
+import httpx
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
 from tqdm import tqdm
 from pathlib import Path
+from itertools import chain
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ROOT = Path(__file__).resolve().parent.parent.parent  # project root
 RAW = ROOT / "data" / "raw"
 
 FLAVORGRAPH_DIR = RAW / "flavorgraph"
 FLAVORDB_DIR = RAW / "flavordb"
+FLAVORDB_PARQUET_DIR = FLAVORDB_DIR / "parquet"  # One .parquet per table
 RECIPE1M_DIR = RAW / "recipe1m"
 MOLECULESTM_DIR = RAW / "moleculestm"
 
@@ -33,6 +49,7 @@ MOLECULESTM_DIR = RAW / "moleculestm"
 
 FLAVORGRAPH_REPO = "https://github.com/lamypark/FlavorGraph.git"
 FLAVORGRAPH_BRANCH = "master"
+FLAVORGRAPH_PATTERNS = ["*.csv", "*.pkl", "*.pt", "*.npy"]  # Files we keep
 
 
 def download_flavorgraph():
@@ -46,12 +63,14 @@ def download_flavorgraph():
 
     FLAVORGRAPH_DIR.mkdir(parents=True, exist_ok=True)
 
-    # Shallow clone to save bandwidth
+    # Shallow, blobless clone with no checkout: only commit + tree objects come down
     tmp_dir = RAW / "_fg_tmp"
     subprocess.run(
         [
             "git",
             "clone",
+            "--filter=blob:none",
+            "--no-checkout",
             "--depth",
             "1",
             "--branch",
@@ -62,13 +81,26 @@ def download_flavorgraph():
         check=True,
     )
 
+    # Sparse checkout so only blobs matching FLAVORGRAPH_PATTERNS are fetched.
+    # Extension patterns need non-cone mode (cone mode matches directories only).
+    subprocess.run(
+        ["git", "-C", str(tmp_dir), "sparse-checkout", "set", "--no-cone"]
+        + FLAVORGRAPH_PATTERNS,
+        check=True,
+    )
+    subprocess.run(
+        ["git", "-C", str(tmp_dir), "checkout", FLAVORGRAPH_BRANCH],
+        check=True,
+    )
+
     # Move relevant files — adjust paths based on actual repo structure
     # The repo structure may vary; inspect after first clone and update these paths
-    for pattern in ["*.csv", "*.pkl", "*.pt", "*.npy"]:
-        for f in tmp_dir.rglob(pattern):
-            dest = FLAVORGRAPH_DIR / f.relative_to(tmp_dir)
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(f, dest)
+    files = list(chain.from_iterable(tmp_dir.rglob(p) for p in FLAVORGRAPH_PATTERNS))
+    for dest_dir in {(FLAVORGRAPH_DIR / f.relative_to(tmp_dir)).parent for f in files}:
+        dest_dir.mkdir(parents=True, exist_ok=True)
+    # tmp_dir sits next to FLAVORGRAPH_DIR, so each move is a rename, not a copy
+    for f in files:
+        shutil.move(f, FLAVORGRAPH_DIR / f.relative_to(tmp_dir))
 
     shutil.rmtree(tmp_dir)
 
@@ -82,113 +114,262 @@ def download_flavorgraph():
             size_mb = f.stat().st_size / (1024 * 1024)
             print(f"    {f.relative_to(FLAVORGRAPH_DIR)} ({size_mb:.1f} MB)")
 
+    _write_stats(FLAVORGRAPH_DIR)
+
 
 # FlavorDB mappings (from API)
 FLAVORDB_API_BASE = "https://cosylab.iiitd.edu.in/flavordb2"
 FLAVORDB_MAX_ENTITY_ID = 1000  # Upper bound of number of entities in DB
+FLAVORDB_MAX_MISSES = 50  # Stop once this many IDs past the last hit came back empty
+FLAVORDB_MAX_ERRORS = 20  # Stop after this many errors with no good response between
+FLAVORDB_CONCURRENCY = 64  # Worker tasks / in-flight requests to the API host
+FLAVORDB_RATE_LIMIT = 32  # Requests per second per host (token bucket refill)
+FLAVORDB_MAX_RETRIES = 4  # Retries on transient failures, with exponential backoff
+FLAVORDB_BACKOFF = 0.5  # Seconds before the first retry; doubles each attempt
+FLAVORDB_RETRY_STATUSES = (429, 502, 503, 504)
+FLAVORDB_HEADERS = {
+    "Accept": "application/json",
+    "User-Agent": "Mozilla/5.0 (FlavorManifold Research)",
+}
 
 
-def download_flavordb():
-    """Download FlavorDB entities and molecule data via the API.
+class TokenBucket:
+    """Async token bucket: refills `rate` tokens/sec, holds at most `capacity`."""
 
-    Endpoint: GET /entity_details?id={entity_id}
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _json_loads(data):
+    """Parse JSON from bytes or str, using orjson when it is installed."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
 
-    Each response contains:
-      - entity_id, category, entity_alias_readable (the ingredient)
-      - molecules[]: array of molecule objects, each containing:
-          - pubchem_id, common_name, smile (SMILES string)
-          - flavor_profile: "@"-delimited descriptor string (e.g. "sweet@fruity@green")
-          - fema_flavor_profile, fooddb_flavor_profile: additional descriptor sources
-          - molecular_weight, functional_groups, cas_id, etc.
 
-    We cache each entity response as raw JSON and also extract structured CSVs
-    for downstream use.
+def _json_dumps(data, indent=True):
+    """Serialize to UTF-8 JSON bytes, pretty-printed (indent=2) unless indent=False."""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(data, indent=2).encode("utf-8")
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _write_json(path, data, compress=False):
+    """Write JSON via a temp file + os.replace, so path is never left half-written.
+
+    With compress=True the JSON is minified and gzipped.
     """
-    print("\n[FlavorDB] Downloading via API...")
-    print(f"  Base URL: {FLAVORDB_API_BASE}/entities_json?id={{id}}")
+    payload = _json_dumps(data, indent=not compress)
+    if compress:
+        payload = gzip.compress(payload, compresslevel=6)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, path)
 
-    FLAVORDB_DIR.mkdir(parents=True, exist_ok=True)
-    raw_dir = FLAVORDB_DIR / "entities_raw"
-    raw_dir.mkdir(exist_ok=True)
 
-    # Test with known good entity ID 0 (Egg)
+# Cached entities are <eid>.json.gz; <eid>.json is the uncompressed format
+# written by older runs and is still read
+_CACHE_NAME_RE = re.compile(r"(\d+)\.json(\.gz)?")
+
+
+def _cached_entities(raw_dir):
+    """Return {entity_id: path} for every cached entity file in raw_dir.
+
+    Listed with one os.scandir pass; where both formats exist for an ID the
+    gzipped file wins.
+    """
+    cached = {}
+    with os.scandir(raw_dir) as it:
+        for e in it:
+            m = _CACHE_NAME_RE.fullmatch(e.name)
+            if m and (m[2] or int(m[1]) not in cached):
+                cached[int(m[1])] = e.path
+    return cached
+
+
+# Response structure
+# The response might be the entity directly, or wrapped in something
+def _extract_entity(data):
+    """Return (entity_dict, is_valid) from whatever the API returns."""
+    if isinstance(data, dict):
+        if "entity_id" in data and "molecules" in data:
+            return data, True
+        # Maybe wrapped: check common wrapper keys
+        for key in ["data", "entity", "result"]:
+            if key in data and isinstance(data[key], dict):
+                inner = data[key]
+                if "entity_id" in inner:
+                    return inner, True
+    elif isinstance(data, list) and len(data) == 1 and isinstance(data[0], dict):
+        return _extract_entity(data[0])
+    return data, False
+
+
+def _specialize_extractor(sample):
+    """Build an _extract_entity equivalent tuned to the shape of sample.
+
+    Every response in a sweep has the same shape as the preflight's, so the
+    fast path checks only that shape; anything else (e.g. an error body for a
+    missing ID) falls through to the general _extract_entity.
+    """
+    if isinstance(sample, dict) and "entity_id" in sample and "molecules" in sample:
+
+        def extract(data):
+            if type(data) is dict and "entity_id" in data and "molecules" in data:
+                return data, True
+            return _extract_entity(data)
+
+        return extract
+
+    if isinstance(sample, dict):
+        for key in ["data", "entity", "result"]:
+            inner = sample.get(key)
+            if isinstance(inner, dict) and "entity_id" in inner:
+
+                def extract(data, key=key):
+                    inner = data.get(key) if type(data) is dict else None
+                    if type(inner) is dict and "entity_id" in inner:
+                        return inner, True
+                    return _extract_entity(data)
+
+                return extract
+
+    return _extract_entity
+
+
+def _load_cache_index(index_file):
+    """Read the append-only cache index into {entity_id: record}.
+
+    Later lines win, so an entity re-downloaded in a later run picks up its
+    newest validators. A torn last line from an interrupted run is ignored.
+    """
+    index = {}
+    if index_file.exists():
+        with open(index_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                index[record["id"]] = record
+    return index
+
+
+def _looks_like_html(raw_bytes):
+    """True if a response body is an HTML page (the API's error/not-found reply).
+
+    Only the first few bytes are inspected, so large pages are never copied
+    or decoded.
+    """
+    return raw_bytes[:64].lstrip()[:5].lower().startswith((b"<!", b"<html"))
+
+
+def _retry_after(headers):
+    """Seconds the server asked us to wait via Retry-After, or 0."""
+    try:
+        return max(0.0, float(headers.get("Retry-After", 0)))
+    except ValueError:  # HTTP-date form; our own backoff applies instead
+        return 0.0
+
+
+async def _get(client, limiters, url, headers=None):
+    """GET url on the shared client; return (status, headers, body bytes).
+
+    Throttled by the token bucket for url's host. Transient failures are
+    retried with exponential backoff, or after the server's Retry-After if longer.
+    """
+    limiter = limiters[urlsplit(url).netloc]
+    for attempt in range(FLAVORDB_MAX_RETRIES + 1):
+        delay = FLAVORDB_BACKOFF * 2**attempt
+        await limiter.acquire()
+        try:
+            resp = await client.get(url, headers=headers)
+        except httpx.TransportError:
+            if attempt == FLAVORDB_MAX_RETRIES:
+                raise
+        else:
+            if (
+                resp.status_code not in FLAVORDB_RETRY_STATUSES
+                or attempt == FLAVORDB_MAX_RETRIES
+            ):
+                return resp.status_code, resp.headers, resp.content
+            delay = max(delay, _retry_after(resp.headers))
+        await asyncio.sleep(delay)
+
+
+async def _preflight_flavordb(client, limiters, raw_dir):
+    """Fetch known good entity ID 0 (Egg) and check the response shape.
+
+    Returns an entity extractor specialized to the observed response shape,
+    or None if the sweep should not go ahead.
+    """
     print("  Testing connectivity with entity ID 0...")
     test_url = f"{FLAVORDB_API_BASE}/entities_json?id=0"
-    context = ssl._create_unverified_context()  # SSL bypass
 
     try:
-        req = urllib.request.Request(
-            test_url,
-            headers={
-                "Accept": "application/json",
-                "User-Agent": "Mozilla/5.0 (FlavorManifold)",
-            },
-        )
-        with urllib.request.urlopen(req, timeout=15, context=context) as resp:
-            content_type = resp.headers.get("Content-Type", "")
-            raw_bytes = resp.read()
-            raw_text = raw_bytes.decode("utf-8", errors="replace")
+        status, headers, raw_bytes = await _get(client, limiters, test_url)
+
+        if not 200 <= status < 300:
+            body = raw_bytes[:300].decode("utf-8", errors="replace")
+            print(f"  ERROR: HTTP {status}")
+            print(f"  Response body: {body}")
+            return None
 
         # Check if we got JSON or HTML error page
-        if (
-            "text/html" in content_type
-            or raw_text.strip().startswith("<!")
-            or raw_text.strip().startswith("<html")
-        ):
+        content_type = headers.get("Content-Type", "")
+        if "text/html" in content_type or _looks_like_html(raw_bytes):
+            head = raw_bytes[:200].decode("utf-8", errors="replace")
             print(f"  ERROR: Server returned HTML instead of JSON.")
             print(f"  Content-Type: {content_type}")
-            print(f"  First 200 chars: {raw_text[:200]}")
+            print(f"  First 200 chars: {head}")
             print(f"  The API may be down or the endpoint may have changed.")
             print(f"  Try opening {test_url} in your browser.")
-            return
-
-        test_data = json.loads(raw_text)
+            return None
 
-        # Print structure for debugging
-        if isinstance(test_data, dict):
-            print(f"  ✓ Got JSON dict. Keys: {list(test_data.keys())[:10]}")
-            print(f"    entity_id: {test_data.get('entity_id', 'MISSING')}")
-            print(
-                f"    entity_alias_readable: {test_data.get('entity_alias_readable', 'MISSING')}"
-            )
-            print(f"    molecules count: {len(test_data.get('molecules', []))}")
-        elif isinstance(test_data, list):
-            print(f"  ✓ Got JSON list with {len(test_data)} items.")
-            if test_data and isinstance(test_data[0], dict):
-                print(f"    First item keys: {list(test_data[0].keys())[:10]}")
-        else:
-            print(f"  ✓ Got JSON {type(test_data).__name__}: {str(test_data)[:200]}")
+        test_data = _json_loads(raw_bytes)
 
-    except urllib.error.HTTPError as e:
-        print(f"  ERROR: HTTP {e.code} {e.reason}")
-        body = e.read().decode("utf-8", errors="replace")[:300]
-        print(f"  Response body: {body}")
-        return
     except Exception as e:
         print(f"  ERROR: {type(e).__name__}: {e}")
         print(f"  Cannot reach {FLAVORDB_API_BASE}")
         print(f"  If this works in your browser, check proxy/firewall settings.")
-        return
+        return None
 
-    # Response structure
-    # The response might be the entity directly, or wrapped in something
-    def extract_entity(data):
-        """Return (entity_dict, is_valid) from whatever the API returns."""
-        if isinstance(data, dict):
-            if "entity_id" in data and "molecules" in data:
-                return data, True
-            # Maybe wrapped: check common wrapper keys
-            for key in ["data", "entity", "result"]:
-                if key in data and isinstance(data[key], dict):
-                    inner = data[key]
-                    if "entity_id" in inner:
-                        return inner, True
-        elif isinstance(data, list) and len(data) == 1 and isinstance(data[0], dict):
-            return extract_entity(data[0])
-        return data, False
+    # Print structure for debugging
+    if isinstance(test_data, dict):
+        print(f"  ✓ Got JSON dict. Keys: {list(test_data.keys())[:10]}")
+        print(f"    entity_id: {test_data.get('entity_id', 'MISSING')}")
+        print(
+            f"    entity_alias_readable: {test_data.get('entity_alias_readable', 'MISSING')}"
+        )
+        print(f"    molecules count: {len(test_data.get('molecules', []))}")
+    elif isinstance(test_data, list):
+        print(f"  ✓ Got JSON list with {len(test_data)} items.")
+        if test_data and isinstance(test_data[0], dict):
+            print(f"    First item keys: {list(test_data[0].keys())[:10]}")
+    else:
+        print(f"  ✓ Got JSON {type(test_data).__name__}: {str(test_data)[:200]}")
 
     # Validate extractor on the test data
-    test_entity, test_valid = extract_entity(test_data)
+    test_entity, test_valid = _extract_entity(test_data)
     if not test_valid:
         print(f"  ERROR: Cannot find entity_id + molecules in response.")
         print(f"  Response structure: {type(test_data).__name__}")
@@ -197,90 +378,434 @@ def download_flavordb():
         print(
             f"  Saving raw test response to {raw_dir / 'TEST_RESPONSE.json'} for inspection."
         )
-        with open(raw_dir / "TEST_RESPONSE.json", "w") as f:
-            json.dump(test_data, f, indent=2)
-        return
+        _write_json(raw_dir / "TEST_RESPONSE.json", test_data)
+        return None
 
-    print(f"  ✓ Preflight passed. Starting sweep of IDs 1–{FLAVORDB_MAX_ENTITY_ID}...")
+    return _specialize_extractor(test_data)
 
-    # Sweep all entity IDs
+
+async def _sweep_flavordb(client, limiters, raw_dir, extract_entity):
+    """Fetch entity IDs 0..FLAVORDB_MAX_ENTITY_ID concurrently into raw_dir.
+
+    FLAVORDB_CONCURRENCY workers pull IDs from a shared queue and hand valid
+    entities to a single writer task, so the network side never waits on disk.
+
+    Cached entities whose ETag/Last-Modified are recorded in entities_raw/index.jsonl
+    are revalidated with a conditional GET (a 304 counts as skipped); cached
+    entities without validators are skipped outright. A 200 whose body hashes
+    to the recorded sha256 also counts as skipped and the file is not rewritten.
+
+    The sweep ends early once the FLAVORDB_MAX_MISSES consecutive IDs right
+    above the highest entity found so far have all come back missing, since
+    IDs are assigned densely.
+
+    Returns (downloaded, skipped, not_found, errors).
+    """
     downloaded = 0
     skipped = 0
     not_found = 0
     errors = []
 
-    id_range = range(0, FLAVORDB_MAX_ENTITY_ID + 1)
-    if tqdm:
-        id_iter = tqdm(id_range, desc="  FlavorDB", unit="id", ncols=80)
-    else:
-        id_iter = id_range
+    consecutive_errors = 0  # reset by any response that isn't an error
+    last_hit = 0  # highest ID known to hold an entity; the preflight found ID 0
+    trailing_misses = set()  # missing IDs above last_hit
+
+    index_file = raw_dir / "index.jsonl"
+    index = _load_cache_index(index_file)
+
+    cached = _cached_entities(raw_dir)
+
+    id_queue = asyncio.Queue()
+    for eid in range(0, FLAVORDB_MAX_ENTITY_ID + 1):
+        if eid not in cached:
+            id_queue.put_nowait((eid, None))
+            continue
 
-    for eid in id_iter:
-        detail_file = raw_dir / f"{eid}.json"
-        if detail_file.exists():
+        record = index.get(eid, {})
+        conditional = {}
+        if record.get("etag"):
+            conditional["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            conditional["If-Modified-Since"] = record["last_modified"]
+        if conditional:
+            id_queue.put_nowait((eid, conditional))
+        else:
             skipped += 1
+            last_hit = eid
+
+    write_queue = asyncio.Queue()
+    stop = asyncio.Event()
+
+    if tqdm:
+        pbar = tqdm(
+            total=FLAVORDB_MAX_ENTITY_ID + 1,
+            initial=skipped,
+            desc="  FlavorDB",
+            unit="id",
+            ncols=80,
+            mininterval=0.5,
+        )
+
+    def hit(eid):
+        nonlocal last_hit, trailing_misses, consecutive_errors
+        consecutive_errors = 0
+        if eid > last_hit:
+            last_hit = eid
+            trailing_misses = {m for m in trailing_misses if m > eid}
+
+    def miss(eid):
+        nonlocal not_found, consecutive_errors
+        not_found += 1
+        consecutive_errors = 0
+        if eid > last_hit:
+            trailing_misses.add(eid)
+            # Responses complete out of order, so stop only once every ID in the
+            # window right above last_hit is a miss, not on any misses past it
+            if (
+                len(trailing_misses) >= FLAVORDB_MAX_MISSES
+                and not stop.is_set()
+                and all(
+                    m in trailing_misses
+                    for m in range(last_hit + 1, last_hit + 1 + FLAVORDB_MAX_MISSES)
+                )
+            ):
+                print(
+                    f"\n  No entities in {FLAVORDB_MAX_MISSES} IDs after ID {last_hit}. "
+                    "Stopping sweep."
+                )
+                stop.set()
+
+    def error(eid, reason):
+        nonlocal consecutive_errors
+        errors.append((eid, reason))
+        consecutive_errors += 1
+        if consecutive_errors >= FLAVORDB_MAX_ERRORS and not stop.is_set():
+            print(f"  Too many errors. Stopping at ID {eid}.")
+            stop.set()
+
+    async def worker():
+        nonlocal downloaded, skipped
+        extract = extract_entity  # local name: LOAD_FAST in the hot loop
+        while not stop.is_set():
+            try:
+                eid, conditional = id_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            url = f"{FLAVORDB_API_BASE}/entities_json?id={eid}"
+            try:
+                status, headers, raw_bytes = await _get(
+                    client, limiters, url, conditional
+                )
+
+                if status == 304:
+                    skipped += 1
+                    hit(eid)
+                elif status in (404, 400, 500):
+                    miss(eid)
+                elif not 200 <= status < 300:
+                    error(eid, f"HTTP {status}")
+                    if len(errors) <= 3:
+                        print(f"  ID {eid}: HTTP {status}")
+                # Skip HTML error pages
+                elif _looks_like_html(raw_bytes):
+                    miss(eid)
+                elif (
+                    digest := hashlib.sha256(raw_bytes).hexdigest()
+                ) == index.get(eid, {}).get("sha256") and conditional is not None:
+                    # Cached file, server ignored our validators but the body is
+                    # unchanged: keep the file, only refresh validators if they moved
+                    record = {
+                        "id": eid,
+                        "etag": headers.get("ETag"),
+                        "last_modified": headers.get("Last-Modified"),
+                        "sha256": digest,
+                    }
+                    if record != index[eid]:
+                        await write_queue.put((None, None, record))
+                    skipped += 1
+                    hit(eid)
+                else:
+                    entity, valid = extract(_json_loads(raw_bytes))
+                    if valid:
+                        record = {
+                            "id": eid,
+                            "etag": headers.get("ETag"),
+                            "last_modified": headers.get("Last-Modified"),
+                            "sha256": digest,
+                        }
+                        path = raw_dir / f"{eid}.json.gz"
+                        await write_queue.put((path, entity, record))
+                        downloaded += 1
+                        hit(eid)
+                        if not tqdm and downloaded % 50 == 0:
+                            print(f"  Fetched {downloaded} entities (at ID {eid})...")
+                    else:
+                        miss(eid)
+
+            except json.JSONDecodeError:
+                miss(eid)
+            except Exception as e:
+                if len(errors) < 3:
+                    print(f"  ID {eid}: {type(e).__name__}: {e}")
+                error(eid, str(e))
+
             if tqdm:
-                id_iter.set_postfix(dl=downloaded, skip=skipped, miss=not_found)
+                pbar.update(1)
+
+    def save(path, entity, record):
+        if path is not None:  # None: index-only update for an unchanged body
+            _write_json(path, entity, compress=True)
+            path.with_suffix("").unlink(missing_ok=True)  # superseded <eid>.json
+        # Index line goes after the payload, so a recorded ETag always
+        # describes a file that is on disk
+        index_f.write(json.dumps(record) + "\n")
+
+    async def writer():
+        # Single consumer: all file writes are serialized off the event loop
+        while (item := await write_queue.get()) is not None:
+            await asyncio.to_thread(save, *item)
+
+    def show_counts():
+        pbar.set_postfix(dl=downloaded, skip=skipped, miss=not_found)
+
+    async def report_progress():
+        # Redraw counters on a timer rather than once per request
+        while True:
+            show_counts()
+            await asyncio.sleep(0.5)
+
+    if tqdm:
+        progress_task = asyncio.create_task(report_progress())
+
+    with open(index_file, "a") as index_f:
+        writer_task = asyncio.create_task(writer())
+        await asyncio.gather(*(worker() for _ in range(FLAVORDB_CONCURRENCY)))
+        await write_queue.put(None)
+        await writer_task
+
+    if tqdm:
+        progress_task.cancel()
+        show_counts()
+        pbar.close()
+
+    return downloaded, skipped, not_found, errors
+
+
+async def _fetch_flavordb(raw_dir):
+    """Run the preflight and the sweep over one keep-alive client.
+
+    HTTP/2 is negotiated via ALPN, so all workers multiplex over a single
+    connection; servers that only speak HTTP/1.1 get a pool of up to
+    FLAVORDB_CONCURRENCY connections instead.
+
+    Returns the sweep counts, or None if the preflight failed.
+    """
+    limiters = defaultdict(
+        lambda: TokenBucket(FLAVORDB_RATE_LIMIT, FLAVORDB_CONCURRENCY)
+    )
+    async with httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,  # httpx does not follow redirects by default
+        verify=False,
+        headers=FLAVORDB_HEADERS,
+        timeout=15.0,
+        limits=httpx.Limits(
+            max_connections=FLAVORDB_CONCURRENCY,
+            max_keepalive_connections=FLAVORDB_CONCURRENCY,
+        ),
+    ) as client:
+        extract_entity = await _preflight_flavordb(client, limiters, raw_dir)
+        if extract_entity is None:
+            return None
+
+        print(
+            f"  ✓ Preflight passed. Starting sweep of IDs 1–{FLAVORDB_MAX_ENTITY_ID}..."
+        )
+        return await _sweep_flavordb(client, limiters, raw_dir, extract_entity)
+
+
+# One non-empty, whitespace-trimmed descriptor between "@" separators
+_DESCRIPTOR_RE = re.compile(r"[^@\s](?:[^@]*[^@\s])?")
+
+# Output tables: FLAVORDB_PARQUET_DIR/<name>.parquet (+ FLAVORDB_DIR/<name>.csv)
+FLAVORDB_TABLES = (
+    "entities",
+    "molecules",
+    "edges_entity_molecule",
+    "edges_molecule_descriptor",
+)
+FLAVORDB_BATCH_ROWS = 8192  # Rows buffered per table before a batch is written
+ENTITY_SCHEMA = pa.schema(
+    [("entity_id", pa.int64()), ("name", pa.string()), ("category", pa.string())]
+)
+MOLECULE_SCHEMA = pa.schema(
+    [
+        ("pubchem_id", pa.int64()),
+        ("common_name", pa.string()),
+        ("smile", pa.string()),
+        ("molecular_weight", pa.float64()),
+        ("functional_groups", pa.string()),
+    ]
+)
+ENTITY_MOLECULE_SCHEMA = pa.schema(
+    [("entity_id", pa.int64()), ("pubchem_id", pa.int64())]
+)
+MOLECULE_DESCRIPTOR_SCHEMA = pa.schema(
+    [("pubchem_id", pa.int64()), ("descriptor", pa.string())]
+)
+
+
+def _as_float(value):
+    """Coerce an API number (or numeric string) to float; None if missing."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_entity_json(path):
+    """Parse one cached entity file into rows for the structured CSVs.
+
+    Returns (entity_row, molecule_rows, entity_molecule_edges, descriptor_pids,
+    descriptors); the last two are parallel columns of molecule-descriptor edges.
+    Runs in a worker process, so it must stay at module level.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as fh:
+        data = _json_loads(fh.read())
+
+    eid = data["entity_id"]
+    name = data.get("entity_alias_readable", data.get("entity_alias", f"entity_{eid}"))
+    category = data.get("category", "unknown")
+
+    molecules = []
+    entity_mol = []
+    desc_pids = []
+    descs = []
+    for mol in data.get("molecules", []):
+        pid = mol.get("pubchem_id")
+        if pid is None:
             continue
 
-        url = f"{FLAVORDB_API_BASE}/entities_json?id={eid}"
-        try:
-            req = urllib.request.Request(
-                url,
-                headers={
-                    "Accept": "application/json",
-                    "User-Agent": "Mozilla/5.0 (FlavorManifold Research)",
-                },
+        molecules.append(
+            (
+                pid,
+                mol.get("common_name", ""),
+                mol.get("smile", ""),
+                _as_float(mol.get("molecular_weight")),
+                mol.get("functional_groups", ""),
             )
-            with urllib.request.urlopen(req, timeout=15, context=context) as resp:
-                raw_text = resp.read().decode("utf-8", errors="replace")
+        )
 
-            # Skip HTML error pages
-            if raw_text.strip().startswith("<!") or raw_text.strip().startswith(
-                "<html"
-            ):
-                not_found += 1
-                if tqdm:
-                    id_iter.set_postfix(dl=downloaded, skip=skipped, miss=not_found)
-                continue
+        entity_mol.append((eid, pid))
 
-            data = json.loads(raw_text)
-            entity, valid = extract_entity(data)
+        # Extract descriptors from flavor_profile (primary, "@"-delimited)
+        fp = mol.get("flavor_profile", "")
+        if fp:
+            found = _DESCRIPTOR_RE.findall(fp.lower())
+            descs.extend(found)
+            desc_pids.extend([pid] * len(found))
 
-            if not valid:
-                not_found += 1
-                if tqdm:
-                    id_iter.set_postfix(dl=downloaded, skip=skipped, miss=not_found)
-                continue
+    return (eid, name, category), molecules, entity_mol, desc_pids, descs
 
-            with open(detail_file, "w") as f:
-                json.dump(entity, f, indent=2)
-            downloaded += 1
 
-            if tqdm:
-                id_iter.set_postfix(dl=downloaded, skip=skipped, miss=not_found)
-            elif downloaded % 50 == 0:
-                print(f"  Fetched {downloaded} entities (at ID {eid})...")
-
-            time.sleep(0.15)
-
-        except urllib.error.HTTPError as e:
-            if e.code in (404, 400, 500):
-                not_found += 1
-            else:
-                errors.append((eid, f"HTTP {e.code}"))
-                if len(errors) <= 3:
-                    print(f"  ID {eid}: HTTP {e.code} {e.reason}")
-        except json.JSONDecodeError:
-            not_found += 1
-        except Exception as e:
-            errors.append((eid, str(e)))
-            if len(errors) <= 3:
-                print(f"  ID {eid}: {type(e).__name__}: {e}")
-            # If we get 20+ consecutive errors, bail
-            if len(errors) >= 20 and all(eid - errors[-20][0] < 25 for _ in [1]):
-                print(f"  Too many errors. Stopping at ID {eid}.")
-                break
+class TableWriter:
+    """Stream rows to FLAVORDB_PARQUET_DIR/<name>.parquet as Arrow record batches.
+
+    Rows are buffered column-wise and flushed every FLAVORDB_BATCH_ROWS, so
+    memory stays bounded while encoding runs in Arrow's C++ writers. If
+    csv_dir is given, the same batches also go to csv_dir/<name>.csv.
+    """
+
+    def __init__(self, name, schema, csv_dir=None):
+        self.schema = schema
+        self.columns = [[] for _ in schema]
+        self.num_rows = 0
+        # zstd + Parquet's default dictionary encoding suit the highly
+        # repetitive id and descriptor columns
+        self.writers = [
+            pq.ParquetWriter(
+                FLAVORDB_PARQUET_DIR / f"{name}.parquet", schema, compression="zstd"
+            )
+        ]
+        if csv_dir is not None:
+            self.writers.append(
+                pcsv.CSVWriter(
+                    csv_dir / f"{name}.csv",
+                    schema,
+                    write_options=pcsv.WriteOptions(quoting_style="needed"),
+                )
+            )
+
+    def write_rows(self, rows):
+        for column, values in zip(self.columns, zip(*rows)):
+            column.extend(values)
+        if len(self.columns[0]) >= FLAVORDB_BATCH_ROWS:
+            self.flush()
+
+    def write_table(self, table):
+        self.flush()
+        for w in self.writers:
+            w.write_table(table)
+        self.num_rows += table.num_rows
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        batch = pa.record_batch(
+            [pa.array(c, type=f.type) for c, f in zip(self.columns, self.schema)],
+            schema=self.schema,
+        )
+        for w in self.writers:
+            w.write_batch(batch)
+        self.num_rows += batch.num_rows
+        self.columns = [[] for _ in self.schema]
+
+    def close(self):
+        self.flush()
+        for w in self.writers:
+            w.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def download_flavordb(emit_csv=False):
+    """Download FlavorDB entities and molecule data via the API.
+
+    Endpoint: GET /entity_details?id={entity_id}
+
+    Each response contains:
+      - entity_id, category, entity_alias_readable (the ingredient)
+      - molecules[]: array of molecule objects, each containing:
+          - pubchem_id, common_name, smile (SMILES string)
+          - flavor_profile: "@"-delimited descriptor string (e.g. "sweet@fruity@green")
+          - fema_flavor_profile, fooddb_flavor_profile: additional descriptor sources
+          - molecular_weight, functional_groups, cas_id, etc.
+
+    We cache each entity response as gzipped JSON and also extract structured
+    tables for downstream use: Parquet under FLAVORDB_PARQUET_DIR, plus CSV
+    copies in FLAVORDB_DIR if emit_csv is set.
+    """
+    print("\n[FlavorDB] Downloading via API...")
+    print(f"  Base URL: {FLAVORDB_API_BASE}/entities_json?id={{id}}")
+
+    FLAVORDB_DIR.mkdir(parents=True, exist_ok=True)
+    # Drop the previous run's stats; they are rewritten only once parsing
+    # finishes, and until then the download summary walks the tree instead
+    (FLAVORDB_DIR / STATS_FILE).unlink(missing_ok=True)
+    raw_dir = FLAVORDB_DIR / "entities_raw"
+    raw_dir.mkdir(exist_ok=True)
+
+    # Preflight + sweep all entity IDs concurrently on one client
+    result = asyncio.run(_fetch_flavordb(raw_dir))
+    if result is None:
+        return
+    downloaded, skipped, not_found, errors = result
 
     print(f"\n  Raw download complete:")
     print(f"    New downloads:  {downloaded}")
@@ -290,97 +815,130 @@ def download_flavordb():
     if errors:
         print(f"    First few errors: {errors[:5]}")
 
-    # Parse raw JSON into structured CSVs for the pipeline
-    print("  Parsing into structured CSVs...")
+    # Parse raw JSON into structured tables for the pipeline
+    print("  Parsing into structured tables...")
+    FLAVORDB_PARQUET_DIR.mkdir(exist_ok=True)
+    csv_dir = FLAVORDB_DIR if emit_csv else None
+    if not emit_csv:
+        # CSVs from an earlier run are left for consumers that still read them,
+        # but they will no longer match the Parquet
+        stale = [FLAVORDB_DIR / f"{name}.csv" for name in FLAVORDB_TABLES]
+        stale = [p.name for p in stale if p.exists()]
+        if stale:
+            print(f"  WARNING: Stale CSVs from an earlier run in {FLAVORDB_DIR}/")
+            print(f"    {', '.join(stale)}")
+            print("    These are not updated. Pass --emit-csv to refresh them.")
+
+    seen_pids = set()  # molecules already written (first occurrence wins)
+    seen_edges = set()  # entity-molecule edges written, packed (eid << 32) | pid
+    desc_pids = []  # molecule-descriptor edges as two flat columns,
+    descs = []  # deduplicated and sorted in bulk once parsing is done
+
+    # Parse files across a process pool; this (single) process collects the
+    # results and streams rows to the output tables as they arrive.
+    # Walk cached entities in numeric ID order and hand workers plain str
+    # paths, which pickle cheaper than Path objects
+    cached = _cached_entities(raw_dir)
+    json_files = [cached[eid] for eid in sorted(cached)]
+    with (
+        multiprocessing.Pool() as pool,
+        TableWriter("entities", ENTITY_SCHEMA, csv_dir) as entity_w,
+        TableWriter("molecules", MOLECULE_SCHEMA, csv_dir) as mol_w,
+        TableWriter(
+            "edges_entity_molecule", ENTITY_MOLECULE_SCHEMA, csv_dir
+        ) as entity_mol_w,
+        TableWriter(
+            "edges_molecule_descriptor", MOLECULE_DESCRIPTOR_SCHEMA, csv_dir
+        ) as mol_desc_w,
+    ):
+        results = pool.imap(_parse_entity_json, json_files, chunksize=16)
+        if tqdm:
+            results = tqdm(
+                results,
+                total=len(json_files),
+                desc="  Parsing",
+                unit="file",
+                ncols=80,
+                mininterval=0.5,
+            )
 
-    entities = []  # (entity_id, name, category)
-    molecules = []  # (pubchem_id, common_name, smile, molecular_weight, functional_groups)
-    entity_mol = []  # (entity_id, pubchem_id)  — ingredient-molecule edges
-    mol_desc = set()  # (pubchem_id, descriptor)  — molecule-descriptor edges
+        for entity, mols, em_edges, md_pids, md_descs in results:
+            entity_w.write_rows([entity])
+            new_mols = []
+            for m in mols:
+                if m[0] not in seen_pids:
+                    seen_pids.add(m[0])
+                    new_mols.append(m)
+            mol_w.write_rows(new_mols)
+            # Packed ints hash faster and take less memory than (eid, pid) tuples;
+            # both ids fit in 32 bits for FlavorDB
+            packed = dict.fromkeys((eid << 32) | pid for eid, pid in em_edges)
+            new_edges = [e for e in packed if e not in seen_edges]
+            seen_edges.update(new_edges)
+            entity_mol_w.write_rows((e >> 32, e & 0xFFFFFFFF) for e in new_edges)
+            desc_pids.extend(md_pids)
+            descs.extend(md_descs)
+
+        mol_desc = (
+            pa.table(
+                [
+                    pa.array(desc_pids, pa.int64()),
+                    pa.array(descs, pa.string()),
+                ],
+                schema=MOLECULE_DESCRIPTOR_SCHEMA,
+            )
+            .group_by(["pubchem_id", "descriptor"])
+            .aggregate([])
+            .sort_by([("pubchem_id", "ascending"), ("descriptor", "ascending")])
+        )
+        mol_desc_w.write_table(mol_desc)
 
-    json_files = sorted(raw_dir.glob("*.json"))
-    if tqdm:
-        json_files = tqdm(json_files, desc="  Parsing", unit="file", ncols=80)
+    print(f"  Entities:                {entity_w.num_rows}")
+    print(f"  Unique molecules:        {mol_w.num_rows}")
+    print(f"  Entity-molecule edges:   {entity_mol_w.num_rows}")
+    print(f"  Molecule-descriptor edges: {mol_desc_w.num_rows}")
+    print(f"  Parquet tables written to {FLAVORDB_PARQUET_DIR}/")
+    if emit_csv:
+        print(f"  CSVs written to {FLAVORDB_DIR}/")
 
-    for f in json_files:
-        with open(f) as fh:
-            data = json.load(fh)
+    _write_stats(FLAVORDB_DIR)
 
-        eid = data["entity_id"]
-        name = data.get(
-            "entity_alias_readable", data.get("entity_alias", f"entity_{eid}")
-        )
-        category = data.get("category", "unknown")
-        entities.append((eid, name, category))
-
-        for mol in data.get("molecules", []):
-            pid = mol.get("pubchem_id")
-            if pid is None:
-                continue
-
-            molecules.append(
-                (
-                    pid,
-                    mol.get("common_name", ""),
-                    mol.get("smile", ""),
-                    mol.get("molecular_weight", ""),
-                    mol.get("functional_groups", ""),
-                )
-            )
 
-            entity_mol.append((eid, pid))
-
-            # Extract descriptors from flavor_profile (primary, "@"-delimited)
-            fp = mol.get("flavor_profile", "")
-            if fp:
-                for desc in fp.split("@"):
-                    desc = desc.strip().lower()
-                    if desc:
-                        mol_desc.add((pid, desc))
-
-    # Deduplicate molecules
-    seen_mols = {}
-    for m in molecules:
-        if m[0] not in seen_mols:
-            seen_mols[m[0]] = m
-
-    entities_csv = FLAVORDB_DIR / "entities.csv"
-    with open(entities_csv, "w", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(["entity_id", "name", "category"])
-        w.writerows(entities)
-
-    molecules_csv = FLAVORDB_DIR / "molecules.csv"
-    with open(molecules_csv, "w", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(
-            [
-                "pubchem_id",
-                "common_name",
-                "smile",
-                "molecular_weight",
-                "functional_groups",
-            ]
-        )
-        w.writerows(seen_mols.values())
+# Download summary
+STATS_FILE = "_stats.json"  # Per-source sidecar with file count + total size
+
 
-    edges_entity_mol_csv = FLAVORDB_DIR / "edges_entity_molecule.csv"
-    with open(edges_entity_mol_csv, "w", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(["entity_id", "pubchem_id"])
-        w.writerows(entity_mol)
+def _tree_stats(root):
+    """Return (file_count, size_bytes) for everything under root in one scandir pass."""
+    file_count = 0
+    size_bytes = 0
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and entry.name != STATS_FILE:
+                    file_count += 1
+                    size_bytes += entry.stat().st_size
+    return file_count, size_bytes
 
-    edges_mol_desc_csv = FLAVORDB_DIR / "edges_molecule_descriptor.csv"
-    with open(edges_mol_desc_csv, "w", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(["pubchem_id", "descriptor"])
-        w.writerows(sorted(mol_desc))
 
-    print(f"  Entities:                {len(entities)}")
-    print(f"  Unique molecules:        {len(seen_mols)}")
-    print(f"  Entity-molecule edges:   {len(entity_mol)}")
-    print(f"  Molecule-descriptor edges: {len(mol_desc)}")
-    print(f"  CSVs written to {FLAVORDB_DIR}/")
+def _write_stats(root):
+    """Record root's totals in its sidecar so the summary doesn't re-walk it."""
+    file_count, size_bytes = _tree_stats(root)
+    with open(Path(root) / STATS_FILE, "w") as f:
+        json.dump({"file_count": file_count, "size_bytes": size_bytes}, f)
+
+
+def _read_stats(root):
+    """Return (file_count, size_bytes) from root's sidecar, walking root if absent."""
+    try:
+        with open(Path(root) / STATS_FILE) as f:
+            stats = json.load(f)
+        return stats["file_count"], stats["size_bytes"]
+    except (OSError, ValueError, KeyError):
+        return _tree_stats(root)
 
 
 SOURCES = {
@@ -401,18 +959,24 @@ def main():
         choices=list(SOURCES.keys()),
         help="Download only a specific source.",
     )
+    parser.add_argument(
+        "--emit-csv",
+        action="store_true",
+        help="Also write FlavorDB tables as CSV (Parquet is always written).",
+    )
     args = parser.parse_args()
+    options = {"fdb": {"emit_csv": args.emit_csv}}
 
     RAW.mkdir(parents=True, exist_ok=True)
 
     if args.only:
         name, fn = SOURCES[args.only]
         print(f"Downloading: {name}")
-        fn()
+        fn(**options.get(args.only, {}))
     else:
         print("Downloading all data sources...")
         for key, (name, fn) in SOURCES.items():
-            fn()
+            fn(**options.get(key, {}))
 
     print("\n" + "=" * 60)
     print("Download summary:")
@@ -425,10 +989,8 @@ def main():
             "mstm": MOLECULESTM_DIR,
         }[key]
         if path.exists():
-            file_count = len([f for f in path.rglob("*") if f.is_file()])
-            total_mb = sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) / (
-                1024 * 1024
-            )
+            file_count, size_bytes = _read_stats(path)
+            total_mb = size_bytes / (1024 * 1024)
             status = f"{file_count} files, {total_mb:.1f} MB"
         else:
             status = "NOT DOWNLOADED"